@@ -1,48 +1,157 @@
 import streamlit as st
-import markdown
+from markdown_it import MarkdownIt
+from markdown_it.common.utils import escapeHtml
 import pdfkit
-import tempfile
 import os
 import re
+import string
+from io import BytesIO
 from datetime import datetime
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 from docx import Document  # for docx export
-from pikepdf import Pdf  # for PDF compression
+import pikepdf
+from pikepdf import Pdf, ObjectStreamMode  # for PDF compression
+
+pikepdf.settings.set_flate_compression_level(9)
 
 # --- Streamlit UI Setup ---
 st.set_page_config(page_title="Markdown to PDF Converter", page_icon="📄")
 
-LIGHT_THEME = """
+STYLES = {
+    "Default": "",
+    "GitHub": "body { font-family: 'Segoe UI'; background: #fff; color: #24292e; } code { background: #f6f8fa; }",
+    "Notion": "body { font-family: 'sans-serif'; background: #fdfdfd; color: #37352f; } h1, h2, h3 { border-bottom: 1px solid #eee; }",
+    "Minimalist": "body { font-family: 'Georgia'; background: #fff; color: #000; line-height: 1.6; } h1, h2 { text-align: center; }",
+    "Dark": "body { background: #121212; color: #e0e0e0; font-family: 'Courier New'; }"
+}
+
+# Documents larger than this only get a truncated live preview by default
+PREVIEW_FULL_LIMIT = 50_000
+PREVIEW_TRUNCATE_AT = 5_000
+
+
+# --- Conversion Helpers ---
+_MD = MarkdownIt("commonmark").enable("table")
+_H1_RE = re.compile(r"# (.+)")
+_FNAME_TRANS = str.maketrans({c: '_' for c in ' /\\:*?"<>|'})
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})(.*)$", re.M)
+_SLUG_KEEP = frozenset(string.ascii_lowercase + string.digits)
+
+
+def _slug(title: str) -> str:
+    out = []
+    prev_dash = False
+    for ch in title.lower():
+        if ch in _SLUG_KEEP:
+            out.append(ch)
+            prev_dash = False
+        elif not prev_dash:
+            out.append('-')
+            prev_dash = True
+    return "".join(out).strip('-') or "section"
+
+
+def _unique_anchor(title: str, used: set) -> str:
+    """Slug for title, suffixed -1, -2, ... if an earlier heading already took it."""
+    base = _slug(title)
+    anchor = base
+    n = 1
+    while anchor in used:
+        anchor = f"{base}-{n}"
+        n += 1
+    used.add(anchor)
+    return anchor
+
+
+def _truncate_preview(md_content: str) -> str:
+    """First PREVIEW_TRUNCATE_AT characters, closing a code fence left open by the cut."""
+    head = md_content[:PREVIEW_TRUNCATE_AT]
+    open_fence = None
+    for m in _FENCE_RE.finditer(head):
+        fence, rest = m.groups()
+        if open_fence is None:
+            open_fence = fence
+        elif fence[0] == open_fence[0] and len(fence) >= len(open_fence) and not rest.strip():
+            open_fence = None
+    if open_fence is not None:
+        head += "\n" + open_fence
+    return head
+
+
+def _heading_text(inline) -> str:
+    """Plain text of a heading's inline token, without markdown syntax or raw HTML."""
+    parts = []
+    for child in inline.children or ():
+        if child.type in ("text", "code_inline", "image"):
+            parts.append(child.content)
+        elif child.type in ("softbreak", "hardbreak"):
+            parts.append(" ")
+    return "".join(parts).strip()
+
+
+@st.cache_data(max_entries=16)
+def build_html(md_content: str, add_toc: bool) -> str:
+    """Convert markdown to HTML, optionally prefixed with a table of contents.
+
+    Cached on its arguments so widget reruns don't re-parse the document.
+    """
+    tokens = _MD.parse(md_content)
+
+    parts = []
+    if add_toc:
+        parts.append("<h2>Table of Contents</h2><ul>")
+        used_anchors = set()
+        for i, token in enumerate(tokens):
+            if token.type == "heading_open":
+                level = int(token.tag[1])
+                title = _heading_text(tokens[i + 1])
+                anchor = _unique_anchor(title, used_anchors)
+                token.attrSet("id", anchor)
+                parts.append(f"<li style='margin-left:{(level-1)*20}px'><a href='#{anchor}'>{escapeHtml(title)}</a></li>")
+        parts.append("</ul>")
+
+    parts.append(_MD.renderer.render(tokens, _MD.options, {}))
+    return "".join(parts)
+
+
+def _make_style(font_size: int, theme: str, split_pages: bool, custom_css: str) -> str:
+    return f"""
     <style>
-        body {
-            background-color: #f9f9f9;
-            color: #333333;
-            font-family: 'Segoe UI', sans-serif;
-            font-size: 14px;
-        }
-        .reportview-container .markdown-text-container {
-            padding: 2rem;
-        }
+        body {{
+            font-size: {font_size}pt;
+            {STYLES.get(theme, '')}
+            {custom_css}
+        }}
+        h1 {{ page-break-before: {'always' if split_pages else 'auto'}; }}
     </style>
-"""
+    """
 
-# --- User Inputs ---
-md_source = st.radio("Choose Input Method", ["Upload .md file", "Write Markdown manually"])
 
-uploaded_filename = None
-if md_source == "Upload .md file":
-    uploaded_file = st.file_uploader("Upload a Markdown (.md) file", type="md")
-    if uploaded_file:
-        uploaded_filename = uploaded_file.name
-        md_content = uploaded_file.read().decode("utf-8")
-    else:
-        md_content = None
-else:
-    md_content = st.text_area("Write Markdown", height=300)
+@st.cache_resource
+def _pdfkit_config():
+    """Locate wkhtmltopdf once per process instead of on every render."""
+    return pdfkit.configuration()
 
-if md_content:
-    st.markdown("### Live Markdown Preview")
-    st.markdown(md_content)
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def _render_pdf(final_html: str, options_key: tuple) -> bytes:
+    """Render HTML to PDF bytes with wkhtmltopdf, cached on the HTML and options."""
+    return pdfkit.from_string(final_html, False, options=dict(options_key), configuration=_pdfkit_config())
+
+
+def _build_docx_bytes(md_content: str) -> bytes:
+    buf = BytesIO()
+    doc = Document()
+    doc.add_paragraph(md_content)
+    doc.save(buf)
+    return buf.getvalue()
+
+
+# --- Converter Panel ---
+@st.fragment
+def _converter_panel(md_content: str, uploaded_filename: Optional[str]) -> None:
+    """PDF options and conversion, rerun on their own so the preview isn't re-rendered."""
     st.markdown("---")
     st.subheader("PDF Customization")
 
@@ -91,46 +200,17 @@ if md_content:
 
     if st.button("🔄 Convert to PDF"):
         try:
-            html = markdown.markdown(md_content)
-
-            if add_toc:
-                toc_html = "<h2>Table of Contents</h2><ul>"
-                for line in md_content.splitlines():
-                    if line.startswith("#"):
-                        level = len(line.split(" ")[0])
-                        title = line[level+1:].strip()
-                        anchor = re.sub(r'[^a-zA-Z0-9]+', '-', title.lower())
-                        toc_html += f"<li style='margin-left:{(level-1)*20}px'><a href='#{anchor}'>{title}</a></li>"
-                        html = html.replace(f"<h{level}>" + title + f"</h{level}>", f"<h{level} id='{anchor}'>" + title + f"</h{level}>")
-                toc_html += "</ul>"
-                html = toc_html + html
-
-            styles = {
-                "Default": "",
-                "GitHub": "body { font-family: 'Segoe UI'; background: #fff; color: #24292e; } code { background: #f6f8fa; }",
-                "Notion": "body { font-family: 'sans-serif'; background: #fdfdfd; color: #37352f; } h1, h2, h3 { border-bottom: 1px solid #eee; }",
-                "Minimalist": "body { font-family: 'Georgia'; background: #fff; color: #000; line-height: 1.6; } h1, h2 { text-align: center; }",
-                "Dark": "body { background: #121212; color: #e0e0e0; font-family: 'Courier New'; }"
-            }
+            html = build_html(md_content, add_toc)
 
-            style = f"""
-            <style>
-                body {{
-                    font-size: {font_size}pt;
-                    {styles.get(theme, '')}
-                    {custom_css}
-                }}
-                h1 {{ page-break-before: {'always' if split_pages else 'auto'}; }}
-            </style>
-            """
+            style = _make_style(font_size, theme, split_pages, custom_css)
 
             watermark_html = f"<div style='position:fixed; top:45%; left:30%; font-size:48px; color:rgba(150,150,150,0.15); transform:rotate(-30deg); z-index:-1'>{watermark}</div>" if watermark else ""
 
-            final_html = f"<html><head>{style}</head><body>{watermark_html}{html}</body></html>"
+            final_html = "".join(["<html><head>", style, "</head><body>", watermark_html, html, "</body></html>"])
 
-            match = re.match(r"# (.+)", md_content)
+            match = _H1_RE.match(md_content)
             if match:
-                filename_base = match.group(1).strip().replace(" ", "_")
+                filename_base = match.group(1).strip().translate(_FNAME_TRANS)
             elif uploaded_filename:
                 filename_base = os.path.splitext(uploaded_filename)[0]
             else:
@@ -144,57 +224,71 @@ if md_content:
                 'quiet': '',
                 'enable-local-file-access': '',
                 'page-size': paper_size,
-                'orientation': orientation
+                'orientation': orientation,
+                **({'footer-right': '[page]/[topage]'} if page_numbers else {}),
+                **({'header-center': header} if header else {}),
+                **({'footer-center': footer} if footer else {}),
             }
-            if page_numbers:
-                options['footer-right'] = '[page]/[topage]'
-            if header:
-                options['header-center'] = header
-            if footer:
-                options['footer-center'] = footer
-
-            temp_files = []
-
-            # Generate PDF
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
-                pdfkit.from_string(final_html, tmp_pdf.name, options=options)
-                temp_files.append(tmp_pdf.name)
-
-                # Compress PDF
-                if compress_pdf:
-                    with open(tmp_pdf.name, 'rb') as original_file:
-                        with open(tmp_pdf.name, 'wb') as compressed_file:
-                            pdf = Pdf.open(original_file)
-                            pdf.save(compressed_file, compress_stream=True)
-
-                # Show preview
-                if show_preview:
-                    st.components.v1.iframe("file://" + tmp_pdf.name, height=600)
-
-                st.success("✅ PDF generated!")
-                with open(tmp_pdf.name, "rb") as f:
-                    st.download_button("Download PDF", f, file_name=filename_pdf)
 
-            # Export .docx
+            # Build the DOCX while wkhtmltopdf runs
+            # (the PDF render stays on the script thread so its cache has a script context)
+            options_key = tuple(sorted(options.items()))
+            docx_bytes = None
             if export_docx:
-                doc = Document()
-                doc.add_paragraph(md_content)
-                doc.save(filename_docx)
-                st.download_button("Download DOCX", filename_docx)
+                with ThreadPoolExecutor(max_workers=1) as ex:
+                    docx_fut = ex.submit(_build_docx_bytes, md_content)
+                    pdf_bytes = _render_pdf(final_html, options_key)
+                    docx_bytes = docx_fut.result()
+            else:
+                pdf_bytes = _render_pdf(final_html, options_key)
+
+            # Compress PDF
+            if compress_pdf:
+                with Pdf.open(BytesIO(pdf_bytes)) as pdf:
+                    out = BytesIO()
+                    pdf.save(out, compress_streams=True, recompress_flate=True, object_stream_mode=ObjectStreamMode.generate)
+                pdf_bytes = out.getvalue()
+
+            # Show preview
+            if show_preview:
+                st.pdf(pdf_bytes, height=600)
+
+            st.success("✅ PDF generated!")
+            st.download_button("Download PDF", pdf_bytes, file_name=filename_pdf)
+
+            # Export .docx
+            if docx_bytes is not None:
+                st.download_button("Download DOCX", docx_bytes, file_name=filename_docx)
 
             if save_html:
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".html") as tmp_html:
-                    tmp_html.write(final_html.encode("utf-8"))
-                    tmp_html.flush()
-                    temp_files.append(tmp_html.name)
-                    with open(tmp_html.name, "rb") as f:
-                        st.download_button("Download HTML", f, file_name=filename_html)
+                st.download_button("Download HTML", final_html.encode("utf-8"), file_name=filename_html)
 
         except Exception as e:
             st.error(f"❌ Conversion failed: {e}")
 
-        for f in temp_files:
-            os.unlink(f)
+
+# --- User Inputs ---
+md_source = st.radio("Choose Input Method", ["Upload .md file", "Write Markdown manually"])
+
+uploaded_filename = None
+if md_source == "Upload .md file":
+    uploaded_file = st.file_uploader("Upload a Markdown (.md) file", type="md")
+    if uploaded_file:
+        uploaded_filename = uploaded_file.name
+        md_content = uploaded_file.getvalue().decode("utf-8", errors="replace")
+    else:
+        md_content = None
+else:
+    md_content = st.text_area("Write Markdown", height=300)
+
+if md_content:
+    st.markdown("### Live Markdown Preview")
+    if len(md_content) < PREVIEW_FULL_LIMIT or st.checkbox("Render full preview", value=False):
+        st.markdown(md_content)
+    else:
+        st.markdown(_truncate_preview(md_content) + "\n\n*...(truncated preview; full document will be converted)*")
+
+    _converter_panel(md_content, uploaded_filename)
 
     st.markdown("""
         <hr style="margin-top: 50px;">